@@ -4,53 +4,96 @@
 # This notebook demonstrates how generators and storage units can be replaced by more fundamental components, and how their parameters map to each other.
 
 import os
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
-from pyomo.environ import Constraint
 
 import pypsa
+from pypsa.descriptors import get_switchable_as_dense as get_as_dense
 
+PYPSA_ROOT = os.path.dirname(pypsa.__file__)
 
-def replace_gen(network, gen_to_replace):
+
+@lru_cache(maxsize=None)
+def _load_network(csv_folder_name):
     """
-    Replace the generator gen_to_replace with a bus for the energy carrier, a
-    link for the conversion from the energy carrier to electricity and a store
-    to keep track of the depletion of the energy carrier and its CO2 emissions.
+    Import the network in csv_folder_name only once; callers which modify
+    the network must work on a copy.
     """
+    return pypsa.Network(csv_folder_name)
 
-    gen = network.generators.loc[gen_to_replace]
 
-    bus_name = "{} {}".format(gen["bus"], gen["carrier"])
-    link_name = "{} converter {} to AC".format(gen_to_replace, gen["carrier"])
-    store_name = "{} store {}".format(gen_to_replace, gen["carrier"])
+def _normalize(inflow):
+    """
+    Normalise each column of inflow by its maximum; columns without positive
+    values are set to zero and NaN values are ignored for the maximum.
+    """
+    inflow_max = np.nanmax(inflow, axis=0, initial=0.0)
+    inflow_pu = np.divide(
+        inflow, inflow_max, out=np.zeros_like(inflow), where=inflow_max > 0.0
+    )
+    return inflow_pu, inflow_max
 
-    network.add("Bus", bus_name, carrier=gen["carrier"])
 
-    network.add(
+def replace_gens(network, gens_to_replace):
+    """
+    Replace the generators gens_to_replace with a bus for each energy carrier,
+    a link for the conversion from the energy carrier to electricity and a
+    store to keep track of the depletion of the energy carrier and its CO2
+    emissions.
+
+    All components of one type are added with a single call to madd. The
+    names of the new components are returned as Series indexed by the
+    replaced generators.
+    """
+
+    gens = network.generators.loc[gens_to_replace]
+    rows = list(gens[["bus", "carrier"]].itertuples())
+
+    bus = gens.bus.to_numpy()
+    efficiency = gens.efficiency.to_numpy()
+
+    bus_names = pd.Series([f"{r.bus} {r.carrier}" for r in rows], gens.index)
+    link_names = pd.Series(
+        [f"{r.Index} converter {r.carrier} to AC" for r in rows], gens.index
+    )
+    store_names = pd.Series([f"{r.Index} store {r.carrier}" for r in rows], gens.index)
+    carrier_bus = bus_names.to_numpy()
+
+    buses = gens.carrier.groupby(bus_names).first()
+    network.madd("Bus", buses.index, carrier=buses.to_numpy())
+
+    network.madd(
         "Link",
-        link_name,
-        bus0=bus_name,
-        bus1=gen["bus"],
-        capital_cost=gen["capital_cost"] * gen["efficiency"],
-        p_nom=gen["p_nom"] / gen["efficiency"],
-        p_nom_extendable=gen["p_nom_extendable"],
-        p_nom_max=gen["p_nom_max"] / gen["efficiency"],
-        p_nom_min=gen["p_nom_min"] / gen["efficiency"],
-        p_max_pu=network.generators_t.p_max_pu.loc[:, gen_to_replace]
-        if gen_to_replace in network.generators_t.p_max_pu.columns
-        else gen["p_max_pu"],
-        p_min_pu=network.generators_t.p_min_pu.loc[:, gen_to_replace]
-        if gen_to_replace in network.generators_t.p_min_pu.columns
-        else gen["p_min_pu"],
-        marginal_cost=gen["marginal_cost"] * gen["efficiency"],
-        efficiency=gen["efficiency"],
+        link_names,
+        bus0=carrier_bus,
+        bus1=bus,
+        capital_cost=gens.capital_cost.to_numpy() * efficiency,
+        p_nom=gens.p_nom.to_numpy() / efficiency,
+        p_nom_extendable=gens.p_nom_extendable.to_numpy(),
+        p_nom_max=gens.p_nom_max.to_numpy() / efficiency,
+        p_nom_min=gens.p_nom_min.to_numpy() / efficiency,
+        p_max_pu=gens.p_max_pu.to_numpy(),
+        p_min_pu=gens.p_min_pu.to_numpy(),
+        marginal_cost=gens.marginal_cost.to_numpy() * efficiency,
+        efficiency=efficiency,
     )
 
-    network.add(
+    for attr in ["p_max_pu", "p_min_pu"]:
+        df = network.generators_t[attr]
+        cols = df.columns.intersection(gens.index)
+        if not cols.empty:
+            network.import_series_from_dataframe(
+                df[cols].rename(columns=link_names), "Link", attr
+            )
+
+    # the store can only be depleted; the scalar per unit limits are kept as
+    # static attributes, so no stores_t.e_min_pu/e_max_pu columns are created
+    network.madd(
         "Store",
-        store_name,
-        bus=bus_name,
+        store_names,
+        bus=carrier_bus,
         e_nom_min=-float("inf"),
         e_nom_max=0,
         e_nom_extendable=True,
@@ -58,161 +101,225 @@ def replace_gen(network, gen_to_replace):
         e_max_pu=0.0,
     )
 
-    network.remove("Generator", gen_to_replace)
+    network.mremove("Generator", gens.index)
 
-    return bus_name, link_name, store_name
+    return bus_names, link_names, store_names
 
 
-def replace_su(network, su_to_replace):
+def replace_gen(network, gen_to_replace):
     """
-    Replace the storage unit su_to_replace with a bus for the energy carrier,
-    two links for the conversion of the energy carrier to and from electricity,
-    a store to keep track of the depletion of the energy carrier and its CO2
-    emissions, and a variable generator for the storage inflow.
-
-    Because the energy size and power size are linked in the storage
-    unit by the max_hours, extra functionality must be added to the LOPF
-    to implement this constraint.
+    Replace the generator gen_to_replace with a bus for the energy carrier, a
+    link for the conversion from the energy carrier to electricity and a store
+    to keep track of the depletion of the energy carrier and its CO2 emissions.
     """
 
-    su = network.storage_units.loc[su_to_replace]
+    bus_names, link_names, store_names = replace_gens(network, [gen_to_replace])
 
-    bus_name = "{} {}".format(su["bus"], su["carrier"])
+    return bus_names.iat[0], link_names.iat[0], store_names.iat[0]
 
-    link_1_name = "{} converter {} to AC".format(su_to_replace, su["carrier"])
 
-    link_2_name = "{} converter AC to {}".format(su_to_replace, su["carrier"])
+def replace_sus(network, sus_to_replace):
+    """
+    Replace the storage units sus_to_replace with a bus for each energy
+    carrier, two links for the conversion of the energy carrier to and from
+    electricity, a store to keep track of the depletion of the energy carrier
+    and its CO2 emissions, and a variable generator for the storage inflow.
 
-    store_name = "{} store {}".format(su_to_replace, su["carrier"])
+    Because the energy size and power size are linked in the storage
+    unit by the max_hours, extra functionality must be added to the
+    optimisation to implement this constraint.
 
-    gen_name = "{} inflow".format(su_to_replace)
+    All components of one type are added with a single call to madd. The
+    names of the new components are returned as Series indexed by the
+    replaced storage units.
+    """
 
-    network.add("Bus", bus_name, carrier=su["carrier"])
+    sus = network.storage_units.loc[sus_to_replace]
+    rows = list(sus[["bus", "carrier"]].itertuples())
+
+    bus = sus.bus.to_numpy()
+    p_nom = sus.p_nom.to_numpy()
+    p_nom_extendable = sus.p_nom_extendable.to_numpy()
+    p_nom_max = sus.p_nom_max.to_numpy()
+    p_nom_min = sus.p_nom_min.to_numpy()
+    max_hours = sus.max_hours.to_numpy()
+    efficiency_dispatch = sus.efficiency_dispatch.to_numpy()
+    # capacity limits of the dispatch link, in units of the energy carrier
+    p_nom_max_carrier = p_nom_max / efficiency_dispatch
+    p_nom_min_carrier = p_nom_min / efficiency_dispatch
+
+    bus_names = pd.Series([f"{r.bus} {r.carrier}" for r in rows], sus.index)
+    link_1_names = pd.Series(
+        [f"{r.Index} converter {r.carrier} to AC" for r in rows], sus.index
+    )
+    link_2_names = pd.Series(
+        [f"{r.Index} converter AC to {r.carrier}" for r in rows], sus.index
+    )
+    store_names = pd.Series([f"{r.Index} store {r.carrier}" for r in rows], sus.index)
+    gen_names = pd.Series([f"{r.Index} inflow" for r in rows], sus.index)
+    carrier_bus = bus_names.to_numpy()
+
+    buses = sus.carrier.groupby(bus_names).first()
+    network.madd("Bus", buses.index, carrier=buses.to_numpy())
 
     # dispatch link
-    network.add(
+    network.madd(
         "Link",
-        link_1_name,
-        bus0=bus_name,
-        bus1=su["bus"],
-        capital_cost=su["capital_cost"] * su["efficiency_dispatch"],
-        p_nom=su["p_nom"] / su["efficiency_dispatch"],
-        p_nom_extendable=su["p_nom_extendable"],
-        p_nom_max=su["p_nom_max"] / su["efficiency_dispatch"],
-        p_nom_min=su["p_nom_min"] / su["efficiency_dispatch"],
-        p_max_pu=su["p_max_pu"],
-        marginal_cost=su["marginal_cost"] * su["efficiency_dispatch"],
-        efficiency=su["efficiency_dispatch"],
+        link_1_names,
+        bus0=carrier_bus,
+        bus1=bus,
+        capital_cost=sus.capital_cost.to_numpy() * efficiency_dispatch,
+        p_nom=p_nom / efficiency_dispatch,
+        p_nom_extendable=p_nom_extendable,
+        p_nom_max=p_nom_max_carrier,
+        p_nom_min=p_nom_min_carrier,
+        p_max_pu=sus.p_max_pu.to_numpy(),
+        marginal_cost=sus.marginal_cost.to_numpy() * efficiency_dispatch,
+        efficiency=efficiency_dispatch,
     )
 
     # store link
-    network.add(
+    network.madd(
         "Link",
-        link_2_name,
-        bus1=bus_name,
-        bus0=su["bus"],
-        p_nom=su["p_nom"],
-        p_nom_extendable=su["p_nom_extendable"],
-        p_nom_max=su["p_nom_max"],
-        p_nom_min=su["p_nom_min"],
-        p_max_pu=-su["p_min_pu"],
-        efficiency=su["efficiency_store"],
+        link_2_names,
+        bus1=carrier_bus,
+        bus0=bus,
+        p_nom=p_nom,
+        p_nom_extendable=p_nom_extendable,
+        p_nom_max=p_nom_max,
+        p_nom_min=p_nom_min,
+        p_max_pu=-sus.p_min_pu.to_numpy(),
+        efficiency=sus.efficiency_store.to_numpy(),
     )
 
-    if (
-        su_to_replace in network.storage_units_t.state_of_charge_set.columns
-        and (
-            ~pd.isnull(network.storage_units_t.state_of_charge_set[su_to_replace])
-        ).any()
-    ):
-        e_max_pu = pd.Series(data=1.0, index=network.snapshots)
-        e_min_pu = pd.Series(data=0.0, index=network.snapshots)
-        non_null = ~pd.isnull(
-            network.storage_units_t.state_of_charge_set[su_to_replace]
-        )
-        e_max_pu[non_null] = network.storage_units_t.state_of_charge_set[su_to_replace][
-            non_null
-        ]
-        e_min_pu[non_null] = network.storage_units_t.state_of_charge_set[su_to_replace][
-            non_null
-        ]
-    else:
-        e_max_pu = 1.0
-        e_min_pu = 0.0
-
-    network.add(
+    network.madd(
         "Store",
-        store_name,
-        bus=bus_name,
-        e_nom=su["p_nom"] * su["max_hours"],
-        e_nom_min=su["p_nom_min"] / su["efficiency_dispatch"] * su["max_hours"],
-        e_nom_max=su["p_nom_max"] / su["efficiency_dispatch"] * su["max_hours"],
-        e_nom_extendable=su["p_nom_extendable"],
-        e_max_pu=e_max_pu,
-        e_min_pu=e_min_pu,
-        standing_loss=su["standing_loss"],
-        e_cyclic=su["cyclic_state_of_charge"],
-        e_initial=su["state_of_charge_initial"],
+        store_names,
+        bus=carrier_bus,
+        e_nom=p_nom * max_hours,
+        e_nom_min=p_nom_min_carrier * max_hours,
+        e_nom_max=p_nom_max_carrier * max_hours,
+        e_nom_extendable=p_nom_extendable,
+        e_max_pu=1.0,
+        e_min_pu=0.0,
+        standing_loss=sus.standing_loss.to_numpy(),
+        e_cyclic=sus.cyclic_state_of_charge.to_numpy(),
+        e_initial=sus.state_of_charge_initial.to_numpy(),
     )
 
-    network.add("Carrier", "rain", co2_emissions=0.0)
+    # the columns are typically absent, in which case no scan is needed
+    soc_set = network.storage_units_t.state_of_charge_set
+    soc_set = soc_set[soc_set.columns.intersection(sus.index)]
+    soc_set = soc_set.loc[:, soc_set.notna().to_numpy().any(axis=0)]
 
-    # inflow from a variable generator, which can be curtailed (i.e. spilled)
-    inflow_max = network.storage_units_t.inflow[su_to_replace].max()
+    if not soc_set.empty:
+        soc_set = soc_set.rename(columns=store_names)
+        network.import_series_from_dataframe(soc_set.fillna(1.0), "Store", "e_max_pu")
+        network.import_series_from_dataframe(soc_set.fillna(0.0), "Store", "e_min_pu")
 
-    if inflow_max == 0.0:
-        inflow_pu = 0.0
-    else:
-        inflow_pu = network.storage_units_t.inflow[su_to_replace] / inflow_max
+    if "rain" not in network.carriers.index:
+        network.add("Carrier", "rain", co2_emissions=0.0)
 
-    print(inflow_pu, type(inflow_pu), type(inflow_pu) in [pd.Series])
+    # inflow from a variable generator, which can be curtailed (i.e. spilled)
+    inflow = get_as_dense(network, "StorageUnit", "inflow")[sus.index].to_numpy(
+        dtype=float
+    )
+    inflow_pu, inflow_max = _normalize(inflow)
 
-    network.add(
+    network.madd(
         "Generator",
-        gen_name,
-        bus=bus_name,
+        gen_names,
+        bus=carrier_bus,
         carrier="rain",
         p_nom=inflow_max,
         p_max_pu=inflow_pu,
     )
 
-    if su["p_nom_extendable"]:
-        ratio2 = su["max_hours"]
-        ratio1 = ratio2 * su["efficiency_dispatch"]
+    fixes = pd.DataFrame(
+        {
+            "link_1": link_1_names.to_numpy(),
+            "link_2": link_2_names.to_numpy(),
+            "ratio_1": max_hours * efficiency_dispatch,
+            "ratio_2": max_hours,
+        },
+        index=pd.Index(store_names.to_numpy(), name="Store-ext"),
+    )[p_nom_extendable]
+
+    if not fixes.empty:
 
         def extra_functionality(network, snapshots):
-            model = network.model
-            model.store_fix_1 = Constraint(
-                rule=lambda model: model.store_e_nom[store_name]
-                == model.link_p_nom[link_1_name] * ratio1
-            )
-            model.store_fix_2 = Constraint(
-                rule=lambda model: model.store_e_nom[store_name]
-                == model.link_p_nom[link_2_name] * ratio2
-            )
+            m = network.model
+            e_nom = m.variables["Store-e_nom"].loc[fixes.index]
+            link_p_nom = m.variables["Link-p_nom"]
+            # one constraint per conversion direction for all stores at once,
+            # the link capacities are aligned to the stores they belong to
+            for i in (1, 2):
+                p_nom = (
+                    link_p_nom.loc[fixes[f"link_{i}"].to_numpy()]
+                    .rename({"Link-ext": "Store-ext"})
+                    .assign_coords({"Store-ext": fixes.index})
+                )
+                lhs = m.linexpr((1, e_nom), (-fixes[f"ratio_{i}"], p_nom))
+                m.add_constraints(lhs == 0, name=f"Store-store_fix_{i}")
 
     else:
         extra_functionality = None
 
-    network.remove("StorageUnit", su_to_replace)
+    network.mremove("StorageUnit", sus_to_replace)
 
-    return bus_name, link_1_name, link_2_name, store_name, gen_name, extra_functionality
+    return (
+        bus_names,
+        link_1_names,
+        link_2_names,
+        store_names,
+        gen_names,
+        extra_functionality,
+    )
+
+
+def replace_su(network, su_to_replace):
+    """
+    Replace the storage unit su_to_replace with a bus for the energy carrier,
+    two links for the conversion of the energy carrier to and from electricity,
+    a store to keep track of the depletion of the energy carrier and its CO2
+    emissions, and a variable generator for the storage inflow.
+
+    Because the energy size and power size are linked in the storage
+    unit by the max_hours, extra functionality must be added to the
+    optimisation to implement this constraint.
+    """
+
+    (
+        bus_names,
+        link_1_names,
+        link_2_names,
+        store_names,
+        gen_names,
+        extra_functionality,
+    ) = replace_sus(network, [su_to_replace])
+
+    return (
+        bus_names.iat[0],
+        link_1_names.iat[0],
+        link_2_names.iat[0],
+        store_names.iat[0],
+        gen_names.iat[0],
+        extra_functionality,
+    )
 
 
 ## Take an example from the git repo which has already been solved
 
-csv_folder_name = os.path.join(
-    os.path.dirname(pypsa.__file__), "../examples/opf-storage-hvdc/opf-storage-data"
-)
+csv_folder_name = f"{PYPSA_ROOT}/../examples/opf-storage-hvdc/opf-storage-data"
 
-results_folder_name = os.path.join(csv_folder_name, "results")
+results_folder_name = f"{csv_folder_name}/results"
 
-network_r = pypsa.Network(csv_folder_name=results_folder_name)
+network_r = _load_network(results_folder_name)
 
 
 ## Demonstrate that the results are unchanged with replacements
 
-network = pypsa.Network(csv_folder_name=csv_folder_name)
+network = _load_network(csv_folder_name).copy()
 
 su_to_replace = "Storage 0"
 
@@ -225,80 +332,80 @@ su_to_replace = "Storage 0"
     extra_functionality,
 ) = replace_su(network, su_to_replace)
 
-network.lopf(
-    network.snapshots, extra_functionality=extra_functionality, formulation="kirchhoff"
-)
+network.optimize(network.snapshots, extra_functionality=extra_functionality)
 
 np.testing.assert_almost_equal(network_r.objective, network.objective, decimal=2)
 
-np.testing.assert_array_almost_equal(
-    network_r.storage_units_t.state_of_charge[su_to_replace],
-    network.stores_t.e[store_name],
-)
-
-np.testing.assert_array_almost_equal(
-    network_r.storage_units_t.p[su_to_replace],
-    -network.links_t.p1[link_1_name] - network.links_t.p0[link_2_name],
+su_r = network_r.storage_units.loc[su_to_replace]
+soc_r = network_r.storage_units_t.state_of_charge[su_to_replace].to_numpy()
+p_r = network_r.storage_units_t.p[su_to_replace].to_numpy()
+e = network.stores_t.e[store_name].to_numpy()
+p1 = network.links_t.p1[link_1_name].to_numpy()
+p0 = network.links_t.p0[link_2_name].to_numpy()
+link_1_p_nom_opt, link_2_p_nom_opt = network.links.loc[
+    [link_1_name, link_2_name], "p_nom_opt"
+]
+
+# check state of charge and dispatch
+np.testing.assert_allclose(
+    np.stack([e, -p1 - p0]), np.stack([soc_r, p_r]), rtol=0, atol=1.5e-6
 )
 
 # check optimised size
-np.testing.assert_allclose(
-    network_r.storage_units.at[su_to_replace, "p_nom_opt"],
-    network.links.at[link_2_name, "p_nom_opt"],
-)
-np.testing.assert_allclose(
-    network_r.storage_units.at[su_to_replace, "p_nom_opt"],
-    network.links.at[link_1_name, "p_nom_opt"]
-    * network_r.storage_units.at[su_to_replace, "efficiency_dispatch"],
-)
+np.testing.assert_allclose(su_r.p_nom_opt, link_2_p_nom_opt)
+np.testing.assert_allclose(su_r.p_nom_opt, link_1_p_nom_opt * su_r.efficiency_dispatch)
 
 
-network = pypsa.Network(csv_folder_name=csv_folder_name)
+network = _load_network(csv_folder_name).copy()
 
 gen_to_replace = "Gas 0"
 
 bus_name, link_name, store_name = replace_gen(network, gen_to_replace)
 
-network.lopf(network.snapshots)
+network.optimize(network.snapshots)
 
 
 np.testing.assert_allclose(network_r.objective, network.objective)
 
+link = network.links.loc[link_name]
+p1 = network.links_t.p1[link_name].to_numpy()
+p_r = network_r.generators_t.p[gen_to_replace].to_numpy()
+
 # check dispatch
-np.testing.assert_allclose(
-    -network.links_t.p1[link_name], network_r.generators_t.p[gen_to_replace]
-)
+np.testing.assert_allclose(-p1, p_r)
 
 # check optimised size
 np.testing.assert_allclose(
     network_r.generators.at[gen_to_replace, "p_nom_opt"],
-    network.links.at[link_name, "p_nom_opt"]
-    * network.links.at[link_name, "efficiency"],
+    link.p_nom_opt * link.efficiency,
 )
 
 
 ## Take another example from the git repo which has already been solved
 
-csv_folder_name = os.path.join(
-    os.path.dirname(pypsa.__file__), "../examples/ac-dc-meshed/ac-dc-data"
-)
+csv_folder_name = f"{PYPSA_ROOT}/../examples/ac-dc-meshed/ac-dc-data"
+
+results_folder_name = f"{csv_folder_name}/results-lopf"
 
-results_folder_name = os.path.join(csv_folder_name, "results-lopf")
+network_r = _load_network(results_folder_name)
 
-network_r = pypsa.Network(csv_folder_name=results_folder_name)
 
+network = _load_network(csv_folder_name).copy()
 
-network = pypsa.Network(csv_folder_name=csv_folder_name)
+# the optimisation fixes the link dispatch to p_set, which the results were
+# not computed with
+network.links_t.p_set.drop(columns=network.links_t.p_set.columns, inplace=True)
 
 gen_to_replace = "Frankfurt Gas"
 
 bus_name, link_name, store_name = replace_gen(network, gen_to_replace)
 
-network.lopf(network.snapshots)
+network.optimize(network.snapshots)
 
 
 np.testing.assert_almost_equal(network_r.objective, network.objective, decimal=5)
 
-np.testing.assert_array_almost_equal(
-    -network.links_t.p1[link_name], network_r.generators_t.p[gen_to_replace]
-)
+p1 = network.links_t.p1[link_name].to_numpy()
+p_r = network_r.generators_t.p[gen_to_replace].to_numpy()
+
+np.testing.assert_allclose(-p1, p_r, rtol=0, atol=1.5e-6)
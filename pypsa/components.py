@@ -1014,7 +1014,9 @@ class Network(Basic):
         pnl = self.pnl(class_name)
 
         for df in pnl.values():
-            df.drop(df.columns.intersection(names), axis=1, inplace=True)
+            to_drop = df.columns.intersection(names)
+            if not to_drop.empty:
+                df.drop(to_drop, axis=1, inplace=True)
 
     def _retrieve_overridden_components(self):
 
@@ -7,7 +7,7 @@ import logging
 
 import pandas as pd
 from linopy.expressions import LinearExpression, merge
-from numpy import arange, cumsum, inf, nan, roll
+from numpy import arange, cumsum, diff, full, inf, nan, repeat, roll
 from scipy import sparse
 from xarray import DataArray, Dataset, zeros_like
 
@@ -533,18 +533,29 @@ def define_kirchhoff_voltage_constraints(n, sns):
             C = 1e5 * sparse.diags(weightings) * sub.C
             ssub = s.loc[snapshots, branches.index].values
 
-            ncycles = C.shape[1]
-
-            for j in range(ncycles):
-                c = C.getcol(j).tocoo()
-                coeffs = DataArray(c.data, dims="_term")
-                vars = DataArray(
-                    ssub[:, c.row],
-                    dims=("snapshot", "_term"),
-                    coords={"snapshot": snapshots},
-                )
-                ds = Dataset({"coeffs": coeffs, "vars": vars})
-                exprs.append(LinearExpression(ds))
+            # only the non-zero entries of each cycle are written out, padded
+            # to the length of the longest cycle of the sub network
+            C = C.tocsc()
+            nterms = diff(C.indptr)
+            cycles = repeat(arange(len(nterms)), nterms)
+            terms = arange(C.nnz) - repeat(C.indptr[:-1], nterms)
+
+            coeffs = full((len(nterms), nterms.max()), nan)
+            coeffs[cycles, terms] = C.data
+            vars = full((len(snapshots), len(nterms), nterms.max()), -1)
+            vars[:, cycles, terms] = ssub[:, C.indices]
+
+            ds = Dataset(
+                {
+                    "coeffs": DataArray(coeffs, dims=("cycles", "_term")),
+                    "vars": DataArray(
+                        vars,
+                        dims=("snapshot", "cycles", "_term"),
+                        coords={"snapshot": snapshots},
+                    ),
+                }
+            )
+            exprs.append(LinearExpression(ds))
 
         if len(exprs):
             exprs = merge(exprs, dim="cycles")
@@ -1447,7 +1447,8 @@ def find_cycles(sub_network, weight="x_pu"):
     # number of 2-edge cycles
     num_multi = len(mgraph.edges()) - len(graph.edges())
 
-    sub_network.C = dok_matrix((len(branches_bus0), len(cycles) + num_multi))
+    # collect the entries of C as triplets and build the sparse matrix at once
+    rows, cols, data = [], [], []
 
     for j, cycle in enumerate(cycles):
 
@@ -1455,7 +1456,9 @@ def find_cycles(sub_network, weight="x_pu"):
             branch = next(iter(mgraph[cycle[i]][cycle[(i + 1) % len(cycle)]].keys()))
             branch_i = branches_i.get_loc(branch)
             sign = +1 if branches_bus0.iat[branch_i] == cycle[i] else -1
-            sub_network.C[branch_i, j] += sign
+            rows.append(branch_i)
+            cols.append(j)
+            data.append(sign)
 
     # counter for multis
     c = len(cycles)
@@ -1471,10 +1474,18 @@ def find_cycles(sub_network, weight="x_pu"):
                 sign = (
                     -1 if branches_bus0.iat[b_i] == branches_bus0.iat[first_i] else +1
                 )
-                sub_network.C[first_i, c] = 1
-                sub_network.C[b_i, c] = sign
+                rows.extend((first_i, b_i))
+                cols.extend((c, c))
+                data.extend((1, sign))
                 c += 1
 
+    # duplicate entries are summed up on conversion
+    sub_network.C = csc_matrix(
+        (data, (rows, cols)),
+        shape=(len(branches_bus0), len(cycles) + num_multi),
+        dtype=float,
+    )
+
 
 def sub_network_lpf(sub_network, snapshots=None, skip_pre=False):
     """
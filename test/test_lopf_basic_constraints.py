@@ -9,6 +9,7 @@ import pandas as pd
 import pytest
 from conftest import SUPPORTED_APIS, optimize
 
+import pypsa
 from pypsa.descriptors import expand_series
 from pypsa.descriptors import get_switchable_as_dense as get_as_dense
 from pypsa.descriptors import nominal_attrs
@@ -218,3 +219,29 @@ def test_tolerance(solved_network, api, func):
         assert abs(description[col]["min"]) < TOLERANCE
         if "max" in description:
             assert description[col]["max"] < TOLERANCE
+
+
+@pytest.mark.parametrize("api", SUPPORTED_APIS)
+def test_non_extendable_nominal_attrs(api):
+    """
+    Non-extendable components get their nominal capacity as optimised value,
+    also if other components of the same class are extendable.
+    """
+    n = pypsa.Network()
+    n.set_snapshots(range(2))
+    n.add("Bus", "bus")
+    n.add("Load", "load", bus="bus", p_set=[5, 20])
+    n.add("Generator", "fix", bus="bus", p_nom=10, marginal_cost=1)
+    n.add(
+        "Generator",
+        "ext",
+        bus="bus",
+        p_nom_extendable=True,
+        capital_cost=10,
+        marginal_cost=2,
+    )
+
+    optimize(n, api)
+
+    assert n.generators.at["fix", "p_nom_opt"] == 10
+    assert n.generators.at["ext", "p_nom_opt"] == pytest.approx(10)